@@ -2,11 +2,13 @@ LSPConnection {
     classvar <connection;
     classvar <providers, <>preprocessor;
     classvar readyMsg = "***LSP READY***";
+    classvar bufferCompactSize = 65536;
+    classvar <maxPacketSize = 6000;
     classvar <handlerThread;
     
     var <>inPort, <>outPort;
-    var socket;
-    var messageLengthExpected, messageBuffer;
+    var socket, recvFunc;
+    var messageBuffer, readPos=0;
     var requestId=0;
     var outstandingRequests;
     var <workspaceFolders;
@@ -43,9 +45,10 @@ LSPConnection {
         });
         
         if (settings[\enabled].asBoolean) {
+            // Run start in a routine, so it can wait between attempts to open the port.
             {
                 connection = LSPConnection().start;
-            }.defer(0.0001)
+            }.fork(AppClock)
         };
         
         Log('LanguageServer.quark').level = \error;
@@ -53,7 +56,25 @@ LSPConnection {
     
     *new {
         |settings|
-        ^super.new.init(this.envirSettings.copy.addAll(settings));
+        ^super.new.init(this.envirSettings.addAll(settings));
+    }
+    
+    *maxPacketSize_ {
+        |size|
+        // Datagrams must carry at least one byte and cannot exceed the UDP payload limit.
+        maxPacketSize = size.asInteger.clip(1, 65507);
+    }
+    
+    *prPacketRanges {
+        |messageSize, packetSize|
+        var ranges = [], offset = 0;
+        
+        while { offset < messageSize } {
+            ranges = ranges.add([offset, min(offset + packetSize, messageSize) - 1]);
+            offset = offset + packetSize;
+        };
+        
+        ^ranges
     }
     
     *envirSettings {
@@ -71,6 +92,7 @@ LSPConnection {
         outPort = settings[\outPort];
         outstandingRequests = ();
         workspaceFolders = List();
+        messageBuffer = String.new(bufferCompactSize);
         
         Log('LanguageServer.quark').level = settings[\logLevel].asSymbol;
         
@@ -83,24 +105,40 @@ LSPConnection {
     }
     
     start {
+        var opened = false, attempts = 0;
+        
+        if (recvFunc.notNil) {
+            Log('LanguageServer.quark').warning("Language server is already started");
+            ^this
+        };
+        
         // @TODO: What do we do before start / after stop? Errors?
         Log('LanguageServer.quark').info("Starting language server, inPort: % outPort:%", inPort, outPort);
         
-        3.do {
-            try {
-                socket = socket ?? { NetAddr("127.0.0.1", outPort) };
-                thisProcess.openUDPPort(inPort, \raw);            
-            } {
+        socket = socket ?? { NetAddr("127.0.0.1", outPort) };
+        
+        // openUDPPort returns false on failure.
+        while { opened.not and: { attempts < 3 } } {
+            attempts = attempts + 1;
+            opened = try { thisProcess.openUDPPort(inPort, \raw) } { false };
+            
+            if (opened.not and: { attempts < 3 }) {
                 Log('LanguageServer.quark').warning("Opening LSP port failed. Probably this is because an old scsynth process is holding onto the port. Killing old servers and trying again...");
                 Server.killAll();
                 0.5.wait();
             };
         };
         
-        thisProcess.addRawRecvFunc({
+        if (opened.not) {
+            Log('LanguageServer.quark').error("Could not open LSP port % after % attempts, language server not started", inPort, attempts);
+            ^this
+        };
+        
+        recvFunc = {
             |msg, time, replyAddr, recvPort|
             this.prOnReceived(time, replyAddr, msg);
-        });
+        };
+        thisProcess.addRawRecvFunc(recvFunc);
         
         // @TODO Is this the only "default" provider we want?
         this.addProvider(InitializeProvider(this, {}));
@@ -151,44 +189,139 @@ LSPConnection {
         
         Log('LanguageServer.quark').info("Message received: %, %, %", time, replyAddr, message);
         
-        this.prParseMessage(message) !? this.prHandleMessage(_)
+        // One failing message must not drop the rest.
+        this.prParseMessage(message).do {
+            |object|
+            try {
+                this.prHandleMessage(object)
+            } {
+                |e|
+                Log('LanguageServer.quark').error("Failed to handle message (%): %", e.errorString, object);
+                e.reportError;
+            }
+        }
     }
     
     prParseMessage {
         |message|
-        var object, found, endOfHeader;
+        var object, objects = List();
+        
+        // Fast path: a lone, complete message is decoded straight from the datagram.
+        if ((readPos >= messageBuffer.size) and: {
+            this.prParseWholeMessage(message, objects)
+        }) {
+            ^objects
+        };
         
-        messageBuffer = messageBuffer ++ message;
+        // Appends in place while there is spare capacity.
+        messageBuffer = messageBuffer.addAll(message);
         
-        if (messageLengthExpected.isNil) {
-            found = messageBuffer.findRegexp("Content-Length: ([0-9]+)\r\n\r(\n)");
-            if (found.size > 0) {
-                messageLengthExpected = found[1][1].asInteger;
-                endOfHeader = found[2][0] + 1;
-                messageBuffer = messageBuffer[endOfHeader..];
-                Log('LanguageServer.quark').info("Expecting % bytes, received % so far", messageLengthExpected, messageBuffer.size());
+        // Drain every complete message; frames that yield no message come back as \skipped.
+        while { (object = this.prParseNextMessage).notNil } {
+            if (object !== \skipped) {
+                objects.add(object);
             }
-        } {
-            Log('LanguageServer.quark').info("Expecting % bytes, received % so far", messageLengthExpected, messageBuffer.size());
         };
         
-        if (messageLengthExpected.notNil and: {
-            messageLengthExpected <= messageBuffer.size
-        }) {
-            try {
-                object = messageBuffer[0..(messageLengthExpected-1)].parseJSON;
-                messageBuffer = messageBuffer[messageLengthExpected..];
-                messageLengthExpected = nil;
-            } {
-                |e|
-                // @TODO: Improve error messaging and behavior.
-                "Problem parsing message (%)".format(e).error;
-                e.reportError;
-            };
-            
-            ^object
+        ^objects
+    }
+    
+    prParseNextMessage {
+        var object, body, length, endOfHeader, bodyStart, bodyEnd;
+        
+        // Nothing is committed until the whole frame is available.
+        endOfHeader = messageBuffer.find("\r\n\r\n", offset: readPos);
+        if (endOfHeader.isNil) { ^nil };
+        
+        bodyStart = endOfHeader + 4;
+        length = this.prParseContentLength(messageBuffer, readPos, endOfHeader);
+        
+        if (length.isNil) {
+            Log('LanguageServer.quark').warning("Skipping message header without a Content-Length");
+            readPos = bodyStart;
+            ^\skipped
+        };
+        
+        bodyEnd = bodyStart + length;
+        if (bodyEnd > messageBuffer.size) {
+            Log('LanguageServer.quark').info("Expecting % bytes, received % so far", length, messageBuffer.size - bodyStart);
+            ^nil
+        };
+        
+        body = messageBuffer.copyRange(bodyStart, bodyEnd - 1);
+        
+        // Consume the frame even if its body does not decode.
+        readPos = bodyEnd;
+        this.prCompactBuffer;
+        
+        object = this.prDecodeBody(body);
+        
+        ^object ?? { \skipped }
+    }
+    
+    prParseWholeMessage {
+        |message, objects|
+        var length, endOfHeader;
+        
+        endOfHeader = message.find("\r\n\r\n");
+        if (endOfHeader.isNil) { ^false };
+        
+        length = this.prParseContentLength(message, 0, endOfHeader);
+        if (length.isNil or: { (endOfHeader + 4 + length) != message.size }) { ^false };
+        
+        this.prDecodeBody(message.copyToEnd(endOfHeader + 4)) !? objects.add(_);
+        ^true
+    }
+    
+    prDecodeBody {
+        |body|
+        var object;
+        
+        try {
+            object = body.parseJSON;
         } {
+            |e|
+            // @TODO: Improve error messaging and behavior.
+            "Problem parsing message (%)".format(e).error;
+            e.reportError;
+        };
+        
+        // Bodies like a bare word still parse (as a YAML scalar), but are not LSP messages.
+        if (object.notNil and: { object.isKindOf(Dictionary).not }) {
+            Log('LanguageServer.quark').warning("Skipping message body that is not a JSON object: %", body);
             ^nil
+        };
+        
+        ^object
+    }
+    
+    prParseContentLength {
+        |string, start, end|
+        var pos, length, digits = 0;
+        
+        // Scan the fixed-format header in place.
+        pos = string.find("Content-Length:", offset: start);
+        if (pos.isNil or: { pos >= end }) { ^nil };
+        
+        pos = pos + 15;
+        while { (pos < end) and: { string[pos] == $  } } { pos = pos + 1 };
+        while { (pos < end) and: { string[pos].isDecDigit } } {
+            // More than 9 digits would overflow a 32-bit Integer.
+            digits = digits + 1;
+            if (digits > 9) { ^nil };
+            
+            length = (length ? 0) * 10 + string[pos].digit;
+            pos = pos + 1;
+        };
+        
+        ^length
+    }
+    
+    prCompactBuffer {
+        // Consumed bytes are only dropped once enough of them have piled up to be worth the copy.
+        if (readPos > bufferCompactSize) {
+            messageBuffer = String.new(bufferCompactSize).addAll(messageBuffer.copyToEnd(readPos));
+            readPos = 0;
         }
     }
     
@@ -328,21 +461,18 @@ LSPConnection {
     
     prSendMessage {
         |dict|
-        var maxSize = 6000;
-        var offset = 0;
-        var packetSize;
         var message = this.prEncodeMessage(dict);
         var messageSize = message.size;
         
         Log('LanguageServer.quark').info("Responding with: %", message);
         
-        if (message.size < maxSize) {
+        // Most messages fit in one packet.
+        if (messageSize <= maxPacketSize) {
             socket.sendRaw(message);
         } {
-            while { offset < messageSize } {
-                packetSize = min(messageSize, maxSize);
-                socket.sendRaw(message[offset..(offset + packetSize - 1)]);
-                offset = offset + packetSize;
+            this.class.prPacketRanges(messageSize, maxPacketSize).do {
+                |range|
+                socket.sendRaw(message.copyRange(range[0], range[1]));
             }
         }
         